@@ -9,14 +9,15 @@
 
 import argparse
 from collections import defaultdict
+from itertools import groupby
 import sys
 import textwrap
 import glob
 import re
 from copy import copy
 from pathlib import Path
-from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
 
 try:
     from bs4 import BeautifulSoup
@@ -28,6 +29,13 @@ except ModuleNotFoundError as e:
         raise e
 
 
+# WARNING Opal-specific special cases
+# Contexts mapped to the same name are considered equal when matching strings.
+_CONTEXT_EQUIVALENTS = {
+    'Opal.About.Common': 'AboutPage',
+}
+
+
 @dataclass
 class Language:
     lang: str
@@ -80,9 +88,20 @@ class TranslatedString:
     translation: 'BeautifulSoup.Tag'
     context: str
     comment: str
+    _plural_forms: Optional[Tuple[str, ...]] = field(default=None, init=False, repr=False)
+    _text: Optional[str] = field(default=None, init=False, repr=False)
+    canonical_context: str = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.canonical_context = _CONTEXT_EQUIVALENTS.get(self.context, self.context)
+
+    def invalidate(self) -> None:
+        # must be called after the translation node has been modified
+        self._plural_forms = None
+        self._text = None
 
     def set_comment(self, value: str) -> None:
-        if node := self.translation.parent.select_one('comment'):
+        if node := self.translation.parent.find('comment', recursive=False):
             node.string = value
         else:
             new_tag = self.parsed.new_tag('comment')
@@ -95,11 +114,7 @@ class TranslatedString:
         if self.source != other.source:
             return 0
 
-        if self.context == other.context:
-            priority += 4
-        # WARNING Opal-specific special cases
-        elif 'Opal.About.Common' in [self.context, other.context] and \
-                'AboutPage' in [self.context, other.context]:
+        if self.canonical_context == other.canonical_context:
             priority += 4
 
         if self.comment == other.comment:
@@ -117,8 +132,7 @@ class TranslatedString:
         if self.has_plurals == other.has_plurals:
             priority += 1
 
-            if len(self.translation.select('numerusform')) == \
-                    len(other.translation.select('numerusform')):
+            if len(self.plural_forms) == len(other.plural_forms):
                 # The number of plural forms may differ. This is not necessarily
                 # an indication that the strings are incompatible.
                 priority += 1
@@ -143,9 +157,22 @@ class TranslatedString:
         else:
             self.translation['type'] = 'unfinished'
 
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.translation.get_text()
+        return self._text
+
     @property
     def has_content(self) -> bool:
-        return self.translation.get_text(strip=True) != ''
+        return self.text.strip() != ''
+
+    @property
+    def plural_forms(self) -> Tuple[str, ...]:
+        if self._plural_forms is None:
+            self._plural_forms = tuple(
+                x.string for x in self.translation.find_all('numerusform', recursive=False))
+        return self._plural_forms
 
     @property
     def has_plurals(self) -> bool:
@@ -161,20 +188,15 @@ class TranslatedString:
             self.translation.parent['numerus'] = ''
 
     def __eq__(self, other) -> bool:
+        # plain string fields are cheaper than attribute lookups in the tree
         if self.source != other.source \
+                or self.comment != other.comment \
                 or self.has_plurals != other.has_plurals \
-                or self.is_finished != other.is_finished \
-                or self.comment != other.comment:
+                or self.is_finished != other.is_finished:
             return False
 
         if self.has_plurals:
-            own_nums = self.translation.select('numerusform')
-            other_nums = other.translation.select('numerusform')
-
-            if len(own_nums) != len(other_nums):
-                return False
-
-            if [x.string for x in own_nums] != [x.string for x in other_nums]:
+            if self.plural_forms != other.plural_forms:
                 return False
         else:
             if self.translation.string != other.translation.string:
@@ -201,29 +223,13 @@ class TsFile:
         if not Path(path).is_file():
             raise FileNotFoundError(path)
 
-        with open(path, 'r') as f:
+        with open(path, 'r', encoding='utf-8') as f:
             parsed = BeautifulSoup(f.read(), 'xml', preserve_whitespace_tags=[
                 'comment', 'translation', 'source', 'numerusform'
             ])
 
-        strings = defaultdict(list)
-        for elem in parsed.select('context > message'):
-            string = elem.source.string
-
-            if string is None or str(string) == '':
-                continue
-
-            if comment := elem.select_one('comment'):
-                comment = comment.get_text(strip=True)
-            else:
-                comment = ''
-
-            strings[elem.source.string] += [
-                TranslatedString(parsed,
-                                 elem.source.string, elem.translation,
-                                 elem.parent.select_one('context > name').string, comment)
-            ]
-
+        # NOTE the language is checked before indexing strings so that
+        #      rejected files are not indexed for nothing
         language = None
         if elem := parsed.find('TS', recursive=False):
             if lang_str := getattr(elem, 'language', ''):
@@ -240,6 +246,30 @@ class TsFile:
             else:
                 language = Language('', '')
 
+        strings = defaultdict(list)
+        for context in parsed.find_all('context'):
+            if name := context.find('name', recursive=False):
+                context_name = name.string
+            else:
+                continue  # not a valid context
+
+            for elem in context.find_all('message', recursive=False):
+                string = elem.source.string
+
+                if string is None or str(string) == '':
+                    continue
+
+                if comment := elem.find('comment', recursive=False):
+                    comment = comment.get_text(strip=True)
+                else:
+                    comment = ''
+
+                strings[elem.source.string] += [
+                    TranslatedString(parsed,
+                                     elem.source.string, elem.translation,
+                                     context_name, comment)
+                ]
+
         return TsFile(Path(path), parsed, strings, language)
 
     def __lt__(self, other: 'TsFile') -> bool:  # required for sorting
@@ -253,10 +283,19 @@ class TsFile:
 class TsDirectory:
     directory: Path
     files: Dict[Language, TsFile]
+    by_language: Dict[Language, List[TsFile]] = field(init=False, repr=False)
 
     class DuplicateLanguageError(Exception):
         pass
 
+    def __post_init__(self) -> None:
+        # files are bucketed by their language without area so that
+        # matching only has to check files that can actually be related
+        self.by_language = defaultdict(list)
+
+        for ts in self.files.values():
+            self.by_language[Language(ts.language.lang, '')].append(ts)
+
     @staticmethod
     def from_disk(path, allow_single_file=False) -> 'TsDirectory':
         path = Path(path)
@@ -331,7 +370,7 @@ class Merger:
         self.new_catalogues: Dict[Language, TsFile] = {}
 
         self.overall_changes: int = 0
-        self.overall_alternatives: Dict[TsFile, Dict[str, List[str]]] = defaultdict(lambda: defaultdict(list))
+        self.overall_alternatives: Dict[Tuple[TsFile, str], Set[str]] = {}
         self.overall_alternatives_count: int = 0
         self.overall_new_catalogues: int = 0
 
@@ -481,7 +520,7 @@ class Merger:
 
         for t in self.target.files.values():
             for s in self.sources:
-                for s_file in s.files.values():
+                for s_file in s.by_language.get(Language(t.language.lang, ''), []):
                     if s_file.language.is_subset_of(t.language):
                         self.pairs[t].append(s_file)
                         self.handled_files.append(s_file)
@@ -544,24 +583,26 @@ class Merger:
                 continue
 
             if target.is_finished and target.has_content and not self.overwrite:
-                alternatives.append(f'source: {matching_source.translation.get_text()}')
-                alternatives.append(f'target: {target.translation.get_text()}')
+                alternatives.append(f'source: {matching_source.text}')
+                alternatives.append(f'target: {target.text}')
                 continue
 
             if matching_source.comment and not target.comment:
                 target.set_comment(matching_source.comment)
 
             if matching_source.has_plurals:
-                for i in target.translation.select('numerusform'):
+                for i in target.translation.find_all('numerusform', recursive=False):
                     i.extract()
 
-                for i in matching_source.translation.select('numerusform'):
+                for i in matching_source.translation.find_all('numerusform', recursive=False):
                     target.translation.append(copy(i))
 
                 target.has_plurals = True
             else:
                 target.translation.string = str(matching_source.translation.string)
 
+            target.invalidate()
+
             target.is_finished = matching_source.is_finished
 
             changes += 1
@@ -572,10 +613,10 @@ class Merger:
         changes = 0
         alternatives = defaultdict(list)
 
-        for key, into_details in target.strings.items():
-            if key not in source.strings:
-                continue
-
+        # NOTE intersecting the key views only visits strings that exist on
+        #      both sides; the smaller side is iterated internally
+        for key in target.strings.keys() & source.strings.keys():
+            into_details = target.strings[key]
             outof_details = source.strings[key]
 
             _key, _changes, _alternatives = self._do_merge_string(key, outof_details, into_details)
@@ -601,7 +642,7 @@ class Merger:
                 total_ambiguous += alternatives_count
 
                 for key, alts in alternatives.items():
-                    self.overall_alternatives[target][key] = list(set(self.overall_alternatives[target][key] + alts))
+                    self.overall_alternatives.setdefault((target, key), set()).update(alts)
 
                 print(f'- {source.path} ({source.language}) [+{changes} / {alternatives_count}]')
 
@@ -618,8 +659,10 @@ class Merger:
         print('saving files...')
 
         for target in self.pairs.keys():
-            with open(str(self.output / target.path.name), 'w') as f:
-                f.write(str(target.parsed))
+            # NOTE written as UTF-8 as declared by the document, not in the
+            #      locale encoding
+            with open(str(self.output / target.path.name), 'wb') as f:
+                f.write(target.parsed.encode('utf-8'))
 
     def _report(self):
         print('')
@@ -646,19 +689,18 @@ class Merger:
 
                 '''))
 
-            summary.append(f'{self.overall_alternatives_count} ambiguous strings in {len(self.overall_alternatives.items())} files')
-            print(f'{self.overall_alternatives_count} AMBIGUOUS STRINGS IN {len(self.overall_alternatives.items())} FILES:')
+            files_count = len({target for target, _ in self.overall_alternatives.keys()})
+            summary.append(f'{self.overall_alternatives_count} ambiguous strings in {files_count} files')
+            print(f'{self.overall_alternatives_count} AMBIGUOUS STRINGS IN {files_count} FILES:')
 
-            for group in sorted(self.overall_alternatives.keys()):
-                all_alts = self.overall_alternatives[group]
-
-                if not all_alts:
-                    continue
+            ordered = sorted(self.overall_alternatives.keys(), key=lambda x: (str(x[0].path), x[1]))
 
-                print(f'- {group.path.name} ({len(all_alts.items())} strings):')
+            for group, group_keys in groupby(ordered, key=lambda x: x[0]):
+                group_keys = list(group_keys)
+                print(f'- {group.path.name} ({len(group_keys)} strings):')
 
-                for key in sorted(all_alts.keys()):
-                    alts = all_alts[key]
+                for _, key in group_keys:
+                    alts = self.overall_alternatives[(group, key)]
                     print(f'    - {key}')
 
                     for a in sorted(alts):